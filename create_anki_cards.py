@@ -1,14 +1,18 @@
 #!/usr/bin/python3
 
 import os
-import json
+import orjson
+import ijson
 import csv
+import functools
+import mmap
 from openai import OpenAI
 from datetime import datetime
 from dotenv import load_dotenv
 import markdown
 import re
 import time
+import tiktoken
 
 load_dotenv()
 
@@ -25,8 +29,16 @@ OPENAI_MODEL = os.getenv("OPENAI_MODEL")
 PROMPT = os.getenv("PROMPT")
 if not PROMPT:
     PROMPT = "Summarize the transcript in up to 10 key points. For each point, provide up to 3 full multi-sentence quotes as supporting evidence:"
+MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", 100000))
+PART_ID_PATTERN = re.compile(r'^(.*)__part(\d+)of(\d+)$')  # Matches custom_ids of transcript parts
+POLL_INITIAL_DELAY = 2  # seconds
+POLL_MAX_DELAY = 5 * 60  # seconds
+POLL_FINAL_DELAY = 10  # seconds, used once the batch is almost done
+CSV_BUFFER_SIZE = 1 << 20  # 1 MiB
+POINT_PATTERN = re.compile(r'^\d+\.\s+(.*)')  # Matches numbers followed by a period and text
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+markdown_converter = markdown.Markdown()
 
 def confirm_continue():
     """
@@ -64,16 +76,39 @@ def remove_batch_id_tmp_file(file_path=BATCH_ID_TMP_FILE):
     except Exception as e:
         print(f"An error occurred: {e}")
 
+@functools.lru_cache(maxsize=None)
+def list_files(directory, extension):
+    """
+    Lists a directory once and returns the names, without extension, of the files with the given extension.
+    """
+    if not os.path.isdir(directory):
+        return frozenset()
+    with os.scandir(directory) as entries:
+        return frozenset(entry.name[:-len(extension)] for entry in entries if entry.name.endswith(extension))
+
+def has_transcript(episode_id):
+    """
+    Checks whether a non-empty transcript exists for a given episode ID.
+    """
+    if episode_id not in list_files(TRANSCRIPT_DIR, ".txt"):
+        return False
+    return os.path.getsize(os.path.join(TRANSCRIPT_DIR, f"{episode_id}.txt")) > 0
+
 def load_transcript(episode_id):
     """
     Loads the transcript for a given episode ID.
     """
     transcript_path = os.path.join(TRANSCRIPT_DIR, f"{episode_id}.txt")
-    if not os.path.exists(transcript_path):
+    if episode_id not in list_files(TRANSCRIPT_DIR, ".txt"):
         #print(f"Transcript for episode {episode_id} not found.")
         return None
-    with open(transcript_path, "r", encoding="utf-8") as file:
-        return file.read()
+    with open(transcript_path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return ""
+        # Decode straight from the mapped pages instead of copying through a read buffer
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # Normalize newlines like the text mode read did
+            return str(mapped, "utf-8").replace("\r\n", "\n").replace("\r", "\n")
 
 def load_results():
     """
@@ -81,25 +116,25 @@ def load_results():
     """
     if not os.path.exists(RESULTS_FILE):
         return {}
-    with open(RESULTS_FILE, "r", encoding="utf-8") as file:
-        return json.load(file)
+    with open(RESULTS_FILE, "rb") as file:
+        return orjson.loads(file.read())
 
 def save_results(results):
     """
     Saves the updated results to the JSON file.
     """
     print("Saving results....")
-    with open(RESULTS_FILE, "w", encoding="utf-8") as file:
-        json.dump(results, file, indent=4)
+    with open(RESULTS_FILE, "wb") as file:
+        file.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
 
 def load_episode_metadata():
     """
-    Loads episode metadata from the detailed_episodes.json file.
+    Streams episode metadata from the detailed_episodes.json file.
     """
     if not os.path.exists(DETAILED_EPISODES_FILE):
         raise FileNotFoundError(f"{DETAILED_EPISODES_FILE} not found.")
-    with open(DETAILED_EPISODES_FILE, "r", encoding="utf-8") as file:
-        return json.load(file)
+    with open(DETAILED_EPISODES_FILE, "rb") as file:
+        yield from ijson.items(file, "item", use_float=True)
 
 def check_missing_results(episode_metadata, results):
     """
@@ -111,24 +146,74 @@ def check_missing_results(episode_metadata, results):
     missing_episode_ids = all_episode_ids - completed_episode_ids
     return list(missing_episode_ids)
 
+def create_task(episode_id, transcript):
+    """
+    Creates a batch task for a single transcript.
+    """
+    return {
+        "custom_id": episode_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": OPENAI_MODEL,
+            "messages": [
+                {"role": "user", "content": f"{PROMPT}\n{transcript}"}
+            ]
+        }
+    }
+
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    """
+    Returns the tokenizer for the configured model.
+    """
+    if not OPENAI_MODEL:
+        return tiktoken.get_encoding("o200k_base")
+    try:
+        return tiktoken.encoding_for_model(OPENAI_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def split_transcript(transcript):
+    """
+    Splits a transcript into equally sized parts that fit into the model's context.
+    """
+    encoding = get_encoding()
+    max_tokens = MAX_INPUT_TOKENS - len(encoding.encode(PROMPT))
+    tokens = encoding.encode(transcript)
+    if len(tokens) <= max_tokens:
+        return [transcript]
+
+    part_count = -(-len(tokens) // max_tokens)
+    part_size = -(-len(tokens) // part_count)
+    return [encoding.decode(tokens[i:i + part_size]) for i in range(0, len(tokens), part_size)]
+
+def create_tasks(transcripts):
+    """
+    Creates the batch tasks from `(episode_id, transcript)` pairs, one per transcript part.
+    Parts of a long transcript get the custom_id `<episode_id>__part<k>of<n>`.
+    An episode ID that already looks like a part ID is sent as `__part0of1` so it stays unambiguous.
+    """
+    for episode_id, transcript in transcripts:
+        parts = split_transcript(transcript)
+        if len(parts) == 1 and not PART_ID_PATTERN.match(episode_id):
+            yield create_task(episode_id, transcript)
+            continue
+
+        if len(parts) > 1:
+            print(f"Splitting transcript for episode {episode_id} into {len(parts)} parts.")
+        for index, part in enumerate(parts):
+            yield create_task(f"{episode_id}__part{index}of{len(parts)}", part)
+
 def create_jsonl_file(transcripts, filename=TASKS_FILE):
     """
-    Creates a JSONL file for the batch tasks.
-    """
-    with open(filename, "w", encoding="utf-8") as file:
-        for episode_id, transcript in transcripts.items():
-            task = {
-                "custom_id": episode_id,
-                "method": "POST",
-                "url": "/v1/chat/completions",
-                "body": {
-                    "model": OPENAI_MODEL,
-                    "messages": [
-                        {"role": "user", "content": f"{PROMPT}\n{transcript}"}
-                    ]
-                }
-            }
-            file.write(json.dumps(task) + "\n")
+    Creates a JSONL file for the batch tasks from an iterable of `(episode_id, transcript)` pairs.
+    """
+    with open(filename, "wb") as file:
+        file.writelines(
+            orjson.dumps(task, option=orjson.OPT_APPEND_NEWLINE)
+            for task in create_tasks(transcripts)
+        )
     print(f"JSONL file created: {filename}")
 
 def upload_jsonl_file(filename):
@@ -168,6 +253,7 @@ def poll_batch_status(batch_id):
     """
     print("Checking Batch (can take up to 24h)...")
     print("You can cancel with Ctrl+C and check again later.")
+    delay = POLL_INITIAL_DELAY
     while True:
         batch = client.batches.retrieve(batch_id)
         if batch.status == "completed":
@@ -176,10 +262,17 @@ def poll_batch_status(batch_id):
         elif batch.status in {"failed", "cancelled"}:
             remove_batch_id_tmp_file()
             raise RuntimeError(f"Batch {batch_id} failed with status: {batch.status}")
-        print(f"Batch {batch_id} status: {batch.status}... waiting... (completed {batch.request_counts.completed} of {batch.request_counts.total})")
-        time.sleep(10)
+        completed = batch.request_counts.completed
+        total = batch.request_counts.total
+        print(f"Batch {batch_id} status: {batch.status}... waiting... (completed {completed} of {total})")
+        time.sleep(delay)
+        if total and completed / total >= 0.9:
+            # Check more often when the batch is almost done
+            delay = POLL_FINAL_DELAY
+        else:
+            delay = min(delay * 1.5, POLL_MAX_DELAY)
 
-def download_batch_results(batch_id, output_filename=BATCH_OUTPUT_FILE):
+def download_batch_results(output_file_id, output_filename=BATCH_OUTPUT_FILE):
     """
     Downloads the results of a completed batch job from OpenAI's Batch API.
 
@@ -188,92 +281,106 @@ def download_batch_results(batch_id, output_filename=BATCH_OUTPUT_FILE):
         output_filename (str): The name of the local file to save the results to.
 
     Returns:
-        list: A list of parsed results from the JSONL file.
+        str: The name of the local file the results were saved to.
     """
 
-    # Download the output file content
-    file_response = client.files.content(batch_id)
-
-    # Save the file content locally
-    with open(output_filename, "w", encoding="utf-8") as file:
-        file.write(file_response.text)
+    # Stream the output file content straight to disk
+    with client.files.with_streaming_response.content(output_file_id) as response:
+        with open(output_filename, "wb") as file:
+            file.writelines(response.iter_bytes())
 
     print(f"Results saved to {output_filename}")
 
     # delete temp stored batch id
     remove_batch_id_tmp_file()
 
-    # Parse the JSONL file content
-    results = []
-    with open(output_filename, "r", encoding="utf-8") as file:
-        for line in file:
-            results.append(json.loads(line))
-
     return output_filename
 
+def parse_points(content):
+    """
+    Parses the AI response into numbered points with their sub-items.
+    """
+    match_point = POINT_PATTERN.match
+    is_first_subitem = False  # Tracks if it's the first sub-item after a main point
+    points = []
+    current_point = []
+
+    for line in content.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+
+        match = match_point(line)
+        if match:
+            # Extract and clean the text, removing the leading number and period
+            text = match.group(1).strip()
+            if current_point:
+                points.append("\n".join(current_point))
+            current_point = []
+            current_point.append(text)
+            is_first_subitem = True  # Reset for detecting the first sub-item
+        elif line.startswith('-'):
+            if is_first_subitem:
+                # Add a blank line before the first sub-item
+                current_point.append('')
+                is_first_subitem = False
+            current_point.append(line)
+        else:
+            current_point.append(line)
+
+    if current_point:
+        points.append("\n".join(current_point))
+
+    return points
+
 def process_batch_results(output_filename):
     """
-    Parses a JSONL file into a dictionary.
-    Keys are `custom_id` from each record where `status_code` is 200,
-    and values are lists of parsed content points from the `choices` array.
+    Streams a JSONL file of batch results.
+    Yields `(custom_id, points)` for each record where `status_code` is 200,
+    where points are the parsed content points from the `choices` array.
+    Parts of a split transcript are combined and yielded once all of them succeeded.
 
-    :param file_path: Path to the JSONL file.
-    :return: Dictionary with parsed data.
+    :param output_filename: Path to the JSONL file.
+    :return: Generator of `(custom_id, points)` tuples.
     """
-    result = {}
-    pattern = re.compile(r'^\d+\.\s+(.*)')  # Matches numbers followed by a period and text
-    is_first_subitem = False  # Tracks if it's the first sub-item after a main point
+    parts = {}  # episode_id -> {part index: points}
 
-    with open(output_filename, 'r', encoding='utf-8') as file:
+    with open(output_filename, 'rb') as file:
         for line in file:
             try:
-                record = json.loads(line.strip())
-
-                # Extract `custom_id` and `response` fields
-                custom_id = record.get("custom_id")
-                response = record.get("response", {})
-
-                # Check if status_code is 200
-                if response.get("status_code") == 200:
-                    # Get content from the choices array
-                    choices = response.get("body", {}).get("choices", [])
-
-                    for choice in choices:
-                        content = choice.get("message", {}).get("content", "")
-
-                    # Parse content into numbered points with sub-items
-                    points = []
-                    current_point = []
-
-                    for line in content.split("\n"):
-                        line = line.strip()
-                        if not line:
-                            continue
-
-                        match = pattern.match(line)
-                        if match:
-                            # Extract and clean the text, removing the leading number and period
-                            content = match.group(1).strip()
-                            if current_point:
-                                points.append("\n".join(current_point))
-                            current_point = []
-                            current_point.append(content)
-                            is_first_subitem = True  # Reset for detecting the first sub-item
-                        elif line.strip().startswith('-'):
-                            if is_first_subitem:
-                                # Add a blank line before the first sub-item
-                                current_point.append('')
-                                is_first_subitem = False
-                            current_point.append(line)
-                        else:
-                            current_point.append(line)
-
-                    result[custom_id] = points
-
-            except json.JSONDecodeError as e:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError as e:
                 print(f"Skipping invalid JSON line: {line.strip()} Error: {e}")
+                continue
+
+            # Extract `custom_id` and `response` fields
+            custom_id = record.get("custom_id")
+            response = record.get("response", {})
+
+            # Check if status_code is 200
+            if response.get("status_code") == 200:
+                # Get content from the choices array
+                content = ""
+                choices = response.get("body", {}).get("choices", [])
+                for choice in choices:
+                    content = choice.get("message", {}).get("content", "")
+
+                points = parse_points(content)
+                part_match = PART_ID_PATTERN.match(custom_id)
+                if not part_match:
+                    yield custom_id, points
+                    continue
 
-    return result
+                episode_id = part_match.group(1)
+                index, part_count = int(part_match.group(2)), int(part_match.group(3))
+                episode_parts = parts.setdefault(episode_id, {})
+                episode_parts[index] = points
+                if len(episode_parts) == part_count:
+                    del parts[episode_id]
+                    yield episode_id, [point for i in sorted(episode_parts) for point in episode_parts[i]]
+
+    for episode_id in parts:
+        print(f"Incomplete results for episode {episode_id}, skipping.")
 
 
 
@@ -285,21 +392,33 @@ def create_flashcards_for_episode(episode_id, metadata, ai_result):
         "author": metadata.get("podcast_author", "Unknown"),
         "date": metadata.get("date", datetime.now().strftime("%Y-%m-%d")),
         "title": f'{metadata.get("podcast_title", "Unknown Podcast")} - {metadata.get("episode_title", "Unknown Episode")}',
-        "quote": markdown.markdown(ai_result.strip())
+        "quote": markdown_converter.reset().convert(ai_result.strip())
     }
 
 def save_flashcards_to_csv(flashcards, filename=OUTPUT_FILE):
     """
     Saves flashcards to a CSV file in a format Anki can import.
     """
-    with open(filename, "w", encoding="utf-8", newline="") as file:
+    rows = [
+        (flashcard["quote"], flashcard["title"], flashcard["author"], flashcard["date"])
+        for flashcard in flashcards
+    ]
+    with open(filename, "w", encoding="utf-8", newline="", buffering=CSV_BUFFER_SIZE) as file:
         writer = csv.writer(file)
-        for flashcard in flashcards:
-            writer.writerow([flashcard["quote"], flashcard["title"], flashcard["author"], flashcard["date"]])
+        writer.writerows(rows)
     print(f"Flashcards saved to {filename}")
 
-def create_new_batch(new_transcripts):
-    create_jsonl_file(new_transcripts)
+def load_transcripts(episode_ids):
+    """
+    Yields `(episode_id, transcript)` for each episode, reading one transcript at a time.
+    """
+    for episode_id in episode_ids:
+        transcript = load_transcript(episode_id)
+        if transcript:
+            yield episode_id, transcript
+
+def create_new_batch(episode_ids):
+    create_jsonl_file(load_transcripts(episode_ids))
     file_id = upload_jsonl_file(TASKS_FILE)
     batch_id = create_batch_request(file_id)
 
@@ -309,47 +428,38 @@ def main():
     """
     Main function to generate flashcards for multiple episodes.
     """
-    episode_metadata = load_episode_metadata()
     results = load_results()
 
     # Check for missing results
-    missing_episode_ids = check_missing_results(episode_metadata, results)
+    missing_episode_ids = check_missing_results(load_episode_metadata(), results)
     if missing_episode_ids:
         #print(f"Missing results for {len(missing_episode_ids)} episodes: {missing_episode_ids}")
         print(f"Missing results for {len(missing_episode_ids)} episodes")
     else:
         print("All episodes have AI-generated results.")
 
-    new_transcripts = {}
-
-    # Load transcripts for processing
-    for episode in episode_metadata:
-        episode_id = episode["episode_id"].replace("/","_")
-        if episode_id in missing_episode_ids:
-            transcript = load_transcript(episode_id)
-            if transcript:
-                new_transcripts[episode_id] = transcript
+    # Transcripts are only read while the batch file is written
+    new_episode_ids = [episode_id for episode_id in missing_episode_ids if has_transcript(episode_id)]
 
     # Generate flashcards for new transcripts
-    if new_transcripts:
-        print(f"Generating flashcards for {len(new_transcripts)} new episodes...")
+    if new_episode_ids:
+        print(f"Generating flashcards for {len(new_episode_ids)} new episodes...")
 
         if confirm_continue():
             print("Continuing...")
             batch_id = check_for_tmp_batch_id()
 
             if not batch_id:
-                batch_id = create_new_batch(new_transcripts)
+                batch_id = create_new_batch(new_episode_ids)
 
             output_file_id = poll_batch_status(batch_id)
             output_filename = download_batch_results(output_file_id)
-            ai_results = process_batch_results(output_filename)
-            results.update(ai_results)
+            results.update(process_batch_results(output_filename))
             save_results(results)
 
             # Create Anki flashcards
             flashcards = []
-            for episode in episode_metadata:
+            for episode in load_episode_metadata():
                 episode_id = episode["episode_id"]
                 if episode_id in results:
                     for item in results[episode_id]:
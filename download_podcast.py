@@ -1,11 +1,15 @@
 #!/usr/bin/python3
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 import feedparser
-import json
+import orjson
 import argparse
+import functools
 from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 import os
 
@@ -19,10 +23,15 @@ PASSWORD = os.getenv("PASSWORD")
 RESULTS_DIR = "results"
 DETAILED_EPISODES_FILE = f"{RESULTS_DIR}/detailed_episodes.json"
 TIMESTAMP_FILE = f"{RESULTS_DIR}/last_timestamp.txt"
+MAX_FEED_WORKERS = 16
 
+# Shared session so connections to the API server are reused
+session = requests.Session()
+session.auth = HTTPBasicAuth(USERNAME, PASSWORD)
+adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.3))
+session.mount("https://", adapter)
+session.mount("http://", adapter)
 
-# Cache for podcast details
-podcast_cache = {}
 
 def get_last_timestamp():
     """Reads the last saved timestamp from the file."""
@@ -58,7 +67,7 @@ def get_episode_actions(since=None, podcast=None, device=None, aggregated=False)
     if aggregated:
         params["aggregated"] = "true"
 
-    response = requests.get(endpoint, auth=HTTPBasicAuth(USERNAME, PASSWORD), params=params)
+    response = session.get(endpoint, params=params)
     if response.status_code != 200:
         raise Exception(f"Failed to fetch episode actions: {response.status_code} {response.text}")
     
@@ -68,33 +77,47 @@ def get_episode_actions(since=None, podcast=None, device=None, aggregated=False)
         save_last_timestamp(data["timestamp"])
     return data
 
+@functools.lru_cache(maxsize=None)
+def parse_feed(podcast_url):
+    """
+    Parses a podcast feed once per run and returns it with a lookup of its entries by id.
+    """
+    feed = feedparser.parse(podcast_url)
+    if feed.bozo:  # Check for parsing errors
+        raise Exception(f"Failed to parse podcast feed: {podcast_url}")
+    return feed, {entry.get("id"): entry for entry in feed.entries}
+
+def prefetch_podcast_feeds(podcast_urls):
+    """
+    Parses the given podcast feeds concurrently so later lookups hit the cache.
+    Feeds that fail to parse are reported when they are looked up.
+    """
+    urls = {url for url in podcast_urls if url}
+    if not urls:
+        return
+
+    # Each URL is submitted once, so no feed is parsed by two threads at the same time
+    with ThreadPoolExecutor(max_workers=MAX_FEED_WORKERS) as executor:
+        wait([executor.submit(parse_feed, url) for url in urls])
+
 def fetch_episode_details(podcast_url, episode_id):
     """
     Fetches the specific episode from the podcast feed and returns its title and author.
-    Only retrieves the episode entry that matches the episode URL.
+    Only retrieves the episode entry that matches the episode id.
     """
-    if podcast_url in podcast_cache:
-        feed = podcast_cache[podcast_url]
-    else:
-        feed = feedparser.parse(podcast_url)
-        if feed.bozo:  # Check for parsing errors
-            raise Exception(f"Failed to parse podcast feed: {podcast_url}")
+    feed, entries_by_id = parse_feed(podcast_url)
 
     podcast_title = feed.feed.get("title", "Unknown Podcast")
 
-    # Find the episode that matches the episode URL
-    for entry in feed.entries:
-        if entry.id == episode_id:
-            episode_title = entry.get("title", "Unknown Episode")
-            episode_author = entry.get("author", entry.get("itunes_author", "Unknown Author"))
-
-            if podcast_url not in podcast_cache:
-                podcast_cache[podcast_url] = feed
+    entry = entries_by_id.get(episode_id)
+    if entry is None:
+        raise Exception(f"Episode not found in the feed: {episode_id}")
 
-            print(episode_title, episode_author)
-            return episode_title, episode_author, podcast_title
+    episode_title = entry.get("title", "Unknown Episode")
+    episode_author = entry.get("author", entry.get("itunes_author", "Unknown Author"))
 
-    raise Exception(f"Episode not found in the feed: {episode_url}")
+    print(episode_title, episode_author)
+    return episode_title, episode_author, podcast_title
 
 def get_fully_listened_episodes_with_details(since=None):
     """
@@ -108,6 +131,9 @@ def get_fully_listened_episodes_with_details(since=None):
         if action.get("action") == "play" and action.get("position") == action.get("total")
     ]
 
+    # Fetch all podcast feeds up front instead of one by one
+    prefetch_podcast_feeds(episode.get("podcast") for episode in fully_listened_episodes)
+
     # Enhance each episode with podcast and author details
     detailed_episodes = []
     for episode in fully_listened_episodes:
@@ -146,8 +172,8 @@ def save_episodes_to_json(detailed_episodes, filename=DETAILED_EPISODES_FILE):
     Saves the list of detailed episodes to a JSON file.
     """
     try:
-        with open(filename, "w", encoding="utf-8") as file:
-            json.dump(detailed_episodes, file, ensure_ascii=False, indent=4)
+        with open(filename, "wb") as file:
+            file.write(orjson.dumps(detailed_episodes, option=orjson.OPT_INDENT_2))
         print(f"Successfully saved episodes to {filename}")
     except Exception as e:
         print(f"Error saving episodes to file: {e}")
@@ -157,14 +183,14 @@ def load_episodes_from_json(filename=DETAILED_EPISODES_FILE):
     Loads the list of detailed episodes from a JSON file.
     """
     try:
-        with open(filename, "r", encoding="utf-8") as file:
-            detailed_episodes = json.load(file)
+        with open(filename, "rb") as file:
+            detailed_episodes = orjson.loads(file.read())
         print(f"Successfully loaded episodes from {filename}")
         return detailed_episodes
     except FileNotFoundError:
         print(f"Error: File {filename} not found.")
         return []
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"Error decoding JSON: {e}")
         return []
     except Exception as e:
@@ -176,20 +202,23 @@ def remove_duplicates_from_json(data, key="episode_id"):
     Removes duplicate entries from a JSON file based on a specified key.
     """
     try:
-        # Remove duplicates
-        unique_items = {}
-        for item in data:
-            unique_items[item[key]] = item  # Overwrite duplicates with the latest occurrence
-
-        # Save the cleaned data back to the file
-        cleaned_data = list(unique_items.values())
+        # Remove duplicates, walking backwards so the latest occurrence is kept
+        seen = set()
+        cleaned_data = []
+        for item in reversed(data):
+            item_key = item[key]
+            if item_key in seen:
+                continue
+            seen.add(item_key)
+            cleaned_data.append(item)
+        cleaned_data.reverse()
 
         print(f"Removed duplicates based on '{key}'.")
         return cleaned_data
 
     except KeyError as e:
         print(f"Error: Missing key '{e}' in one or more entries.")
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"Error decoding JSON: {e}")
     except Exception as e:
         print(f"Error processing file: {e}")
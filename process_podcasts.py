@@ -1,9 +1,15 @@
 #!/usr/bin/python3
 
 import os
-import json
+import functools
+import orjson
+import ijson
+import subprocess
+import tempfile
 import requests
-from pydub import AudioSegment
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 from dotenv import load_dotenv
 
@@ -15,68 +21,226 @@ TRANSCRIPT_DIR = "transcripts"
 RESULTS_DIR = "results"
 DETAILED_EPISODES_FILE = f"{RESULTS_DIR}/detailed_episodes.json"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+MAX_WORKERS = 8
+CHUNK_WORKERS = 2  # per episode, so at most MAX_WORKERS * CHUNK_WORKERS transcriptions run at once
+CHUNK_SECONDS = 20 * 60  # 20 minutes, upper bound for a chunk
+MAX_CHUNK_BYTES = 24 * 1000 * 1000  # stays below Whisper's 25 MB upload limit
+REENCODE_BIT_RATE = 128000  # used for sources that are not mp3
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_SEGMENTS = 4
+
+client = OpenAI(api_key=OPENAI_API_KEY)
+
+# Shared session so connections to podcast hosts are reused
+session = requests.Session()
+# Sized for every episode worker downloading all of its segments from the same host
+adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=MAX_WORKERS * DOWNLOAD_SEGMENTS,
+    max_retries=Retry(total=3, backoff_factor=0.3)
+)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
 
 def ensure_directories():
     os.makedirs(EPISODE_DIR, exist_ok=True)
     os.makedirs(TRANSCRIPT_DIR, exist_ok=True)
     os.makedirs(RESULTS_DIR, exist_ok=True)
 
+@functools.lru_cache(maxsize=None)
+def list_files(directory, extension):
+    """
+    Lists a directory once and returns the names, without extension, of the files with the given extension.
+    """
+    if not os.path.isdir(directory):
+        return frozenset()
+    with os.scandir(directory) as entries:
+        return frozenset(entry.name[:-len(extension)] for entry in entries if entry.name.endswith(extension))
+
+def transcript_exists(episode_id):
+    """
+    Checks the cached listing first and only stats the file on a miss,
+    since transcripts written during this run are not in the listing.
+    """
+    return (
+        episode_id in list_files(TRANSCRIPT_DIR, ".txt")
+        or os.path.exists(os.path.join(TRANSCRIPT_DIR, f"{episode_id}.txt"))
+    )
+
 def load_episodes(filename="detailed_episodes.json"):
-    with open(filename, "r", encoding="utf-8") as file:
-        return json.load(file)
+    with open(filename, "rb") as file:
+        yield from ijson.items(file, "item", use_float=True)
 
 def save_episodes(data, filename="detailed_episodes.json"):
-    with open(filename, "w", encoding="utf-8") as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
+    with open(filename, "wb") as file:
+        file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+def download_stream(url, local_path):
+    response = session.get(url, stream=True)
+    response.raise_for_status()
+
+    with open(local_path, "wb") as file:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            file.write(chunk)
+
+class RangeRequestError(Exception):
+    """
+    Raised when a server does not answer a range request with the requested range.
+    """
+
+def download_range(url, local_path, start, end, size):
+    response = session.get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True)
+    response.raise_for_status()
+    if response.status_code != 206:
+        response.close()
+        raise RangeRequestError(f"Server ignored range request for {url}")
+
+    content_range = response.headers.get("Content-Range", "")
+    if content_range != f"bytes {start}-{end}/{size}":
+        response.close()
+        raise RangeRequestError(f"Unexpected Content-Range '{content_range}' for bytes {start}-{end} of {url}")
+
+    fd = os.open(local_path, os.O_WRONLY)
+    try:
+        offset = start
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+    finally:
+        os.close(fd)
+
+    # A dropped connection would otherwise leave a zero-filled hole in the file
+    if offset != end + 1:
+        raise RangeRequestError(f"Received {offset - start} of {end - start + 1} bytes for bytes {start}-{end} of {url}")
+
+def download_ranges(url, local_path, size):
+    """
+    Downloads the file in parallel byte ranges written at their offsets.
+    """
+    with open(local_path, "wb") as file:
+        file.truncate(size)
+
+    segment_size = -(-size // DOWNLOAD_SEGMENTS)
+    starts = range(0, size, segment_size)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_SEGMENTS) as executor:
+        futures = [
+            executor.submit(download_range, url, local_path, start, min(start + segment_size, size) - 1, size)
+            for start in starts
+        ]
+        for future in futures:
+            future.result()
 
 def download_episode(url, episode_id):
     local_path = os.path.join(EPISODE_DIR, f"{episode_id}.mp3")
-    if os.path.exists(local_path):
+    if episode_id in list_files(EPISODE_DIR, ".mp3") or os.path.exists(local_path):
         print(f"Episode {episode_id} already downloaded.")
         return local_path
 
     print(f"Downloading episode {episode_id}...")
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
+    # Download to a temporary name so interrupted downloads are not mistaken for complete ones
+    partial_path = f"{local_path}.part"
+    head = session.head(url, allow_redirects=True)
+    size = int(head.headers.get("Content-Length", 0))
 
-    with open(local_path, "wb") as file:
-        for chunk in response.iter_content(chunk_size=8192):
-            file.write(chunk)
+    if head.ok and head.headers.get("Accept-Ranges") == "bytes" and size > 0:
+        try:
+            download_ranges(head.url, partial_path, size)
+        except RangeRequestError as e:
+            print(f"Range download failed for episode {episode_id} ({e}), downloading in one stream...")
+            download_stream(url, partial_path)
+    else:
+        download_stream(url, partial_path)
+    os.replace(partial_path, local_path)
 
     print(f"Episode {episode_id} downloaded to {local_path}.")
     return local_path
 
-def split_audio(file_path):
-    audio = AudioSegment.from_file(file_path)
-    chunks = []
-    max_chunk_size = 20 * 60 * 1000  # 20 minutes in milliseconds
+def probe_audio(file_path):
+    """
+    Returns the codec name and bitrate (bits per second, 0 if unknown) of the first audio stream.
+    """
+    result = subprocess.run(
+        [
+            "ffprobe", "-v", "error", "-select_streams", "a:0",
+            "-show_entries", "format=bit_rate,duration:stream=codec_name",
+            "-of", "json", file_path
+        ],
+        capture_output=True,
+        check=True
+    )
+    info = orjson.loads(result.stdout)
+    streams = info.get("streams") or [{}]
+    codec_name = streams[0].get("codec_name")
+    file_format = info.get("format", {})
+
+    bit_rate = float(file_format.get("bit_rate") or 0)
+    if not bit_rate:
+        # Fall back to the average bitrate from file size and duration
+        duration = float(file_format.get("duration") or 0)
+        if duration:
+            bit_rate = os.path.getsize(file_path) * 8 / duration
 
-    for i in range(0, len(audio), max_chunk_size):
-        chunks.append(audio[i:i + max_chunk_size])
+    return codec_name, bit_rate
+
+def get_chunk_seconds(bit_rate):
+    """
+    Returns the chunk length in seconds that keeps each chunk below MAX_CHUNK_BYTES.
+    """
+    if not bit_rate:
+        return CHUNK_SECONDS
+    return max(1, min(CHUNK_SECONDS, int(MAX_CHUNK_BYTES * 8 / bit_rate)))
+
+def split_audio(file_path, output_dir):
+    """
+    Splits the audio file into mp3 chunks with ffmpeg.
+    MP3 sources are stream-copied, other codecs (e.g. AAC) are re-encoded to mp3.
+    Returns the sorted list of chunk file paths.
+    """
+    codec_name, bit_rate = probe_audio(file_path)
+    if codec_name == "mp3":
+        codec_args = ["-c", "copy"]
+    else:
+        codec_args = ["-c:a", "libmp3lame", "-b:a", str(REENCODE_BIT_RATE)]
+        bit_rate = REENCODE_BIT_RATE
 
-    return chunks
+    subprocess.run(
+        [
+            "ffmpeg", "-loglevel", "error", "-i", file_path,
+            *codec_args, "-map", "0:a:0",
+            "-f", "segment", "-segment_time", str(get_chunk_seconds(bit_rate)),
+            os.path.join(output_dir, "chunk_%03d.mp3")
+        ],
+        check=True
+    )
+    return sorted(
+        os.path.join(output_dir, name)
+        for name in os.listdir(output_dir)
+        if name.startswith("chunk_")
+    )
 
-def transcribe_chunk(chunk, chunk_id):
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    chunk.export(f"{chunk_id}.mp3", format="mp3")
-    with open(f"{chunk_id}.mp3", "rb") as audio_file:
+# Transcriptions are requested synchronously: the Batch API only accepts JSON
+# request bodies for its text endpoints and has no /v1/audio/transcriptions
+# support, so chunks are parallelized locally instead.
+def transcribe_chunk(chunk_path):
+    with open(chunk_path, "rb") as audio_file:
         response = client.audio.transcriptions.create(
             model="whisper-1",
             file=audio_file,
             response_format="text"
         )
-    os.remove(f"{chunk_id}.mp3")
     return response
 
 def transcribe_episode(file_path, episode_id):
     transcript_path = os.path.join(TRANSCRIPT_DIR, f"{episode_id}.txt")
-    if os.path.exists(transcript_path):
+    if transcript_exists(episode_id):
         print(f"Transcript for episode {episode_id} already exists.")
         return transcript_path
 
     print(f"Transcribing episode {episode_id}...")
-    chunks = split_audio(file_path)
-    transcripts = [transcribe_chunk(chunk, f"{episode_id}_chunk_{i}") for i, chunk in enumerate(chunks)]
+    with tempfile.TemporaryDirectory() as chunk_dir:
+        chunks = split_audio(file_path, chunk_dir)
+        with ThreadPoolExecutor(max_workers=CHUNK_WORKERS) as executor:
+            transcripts = list(executor.map(transcribe_chunk, chunks))
     full_transcript = "\n".join(transcripts)
 
     with open(transcript_path, "w", encoding="utf-8") as file:
@@ -85,6 +249,25 @@ def transcribe_episode(file_path, episode_id):
     print(f"Transcript for episode {episode_id} saved to {transcript_path}.")
     return transcript_path
 
+def process_episode(episode):
+    """
+    Downloads and transcribes a single episode and returns the updated episode.
+    Errors are reported and leave the episode unchanged so other episodes still get saved.
+    """
+    episode_id = episode['episode_id'].replace("/","_")
+
+    if transcript_exists(episode_id):
+        print(f"Transcript for episode {episode_id} already exists. Skipping download.")
+        return episode
+
+    try:
+        episode_file = download_episode(episode["episode_url"], episode_id)
+        transcript_file = transcribe_episode(episode_file, episode_id)
+        episode["transcript_file"] = transcript_file
+    except Exception as e:
+        print(f"Error processing episode {episode_id}: {e}")
+    return episode
+
 def process_episodes(filename=DETAILED_EPISODES_FILE):
     """
     Processes episodes: transcribes and updates the JSON file if no transcript exists.
@@ -94,18 +277,9 @@ def process_episodes(filename=DETAILED_EPISODES_FILE):
     #model = WhisperModel(WHISPER_MODEL, device="cpu")  # Adjust model and device as needed
 
     episodes = load_episodes(filename)
-    for episode in episodes:
-        episode_id = episode['episode_id'].replace("/","_")
-        transcript_path = os.path.join(TRANSCRIPT_DIR, f"{episode_id}.txt")
-
-        if os.path.exists(transcript_path):
-            print(f"Transcript for episode {episode_id} already exists. Skipping download.")
-            continue
-        
-        episode_file = download_episode(episode["episode_url"], episode_id)
-        transcript_file = transcribe_episode(episode_file, episode_id)
-        episode["transcript_file"] = transcript_file
-    
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        episodes = list(executor.map(process_episode, episodes))
+
     save_episodes(episodes, filename)
 
 if __name__ == "__main__":